@@ -1,20 +1,36 @@
 import argparse
+import contextlib
+import functools
+import importlib.util
 import os
+import pathlib
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 import torch
 import torch.nn.functional as F
+import torchvision
+import transformers
+from packaging import version
+from torchvision.io import ImageReadMode
 from transformers import AutoTokenizer, BitsAndBytesConfig, CLIPImageProcessor
 
 from model.LISA import LISAForCausalLM
 from model.llava import conversation as conversation_lib
 from model.llava.mm_utils import tokenizer_image_token
+from model.llava.model.llama_sdpa_attn_monkey_patch import \
+    replace_llama_attn_with_sdpa
 from model.segment_anything.utils.transforms import ResizeLongestSide
 from utils.utils import (DEFAULT_IM_END_TOKEN, DEFAULT_IM_START_TOKEN,
                          DEFAULT_IMAGE_TOKEN, IMAGE_TOKEN_INDEX)
 
+try:
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+except ImportError:
+    SDPBackend, sdpa_kernel = None, None
+
 # Fixed prompt
 PROMPT1 = """
 - People who are walking or riding kick scooters (including electric kick scooters), segways, skateboards, etc. are labeled as pedestrians.
@@ -50,6 +66,17 @@ pedestrian
 PROMPT4 = """
 """
 
+# zlib level 1 encodes several times faster than the default 3 for a few percent
+# larger files, which matters since every frame writes two PNGs
+PNG_IMAGE_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+PNG_MASK_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1, cv2.IMWRITE_PNG_BILEVEL, 1]
+
+# transformers version and extra packages needed to load pre-quantized checkpoints
+QUANTIZATION_REQUIREMENTS = {
+    "gptq": ("4.35.0", ["optimum", "auto_gptq"]),
+    "awq": ("4.39.0", ["awq"]),
+}
+
 Prompts = {
   1:PROMPT1,
   2:PROMPT2,
@@ -57,30 +84,66 @@ Prompts = {
   4:PROMPT4
 }
 
-def collect_pairs(root_dir):
+def collect_clip_pairs(image_clip_path, label_clip_path):
+    """
+    Pair the frames of one images/<clip> directory with their label files.
+    Each entry is (image_path, label_path, label_dir, label_stem), the last two
+    name the mask outputs so the frame loop does no path parsing.
+    """
     image_label_pairs = []
+    if not os.path.isdir(label_clip_path):
+        return image_label_pairs
+
+    # One scandir per label directory replaces an isdir/exists stat per entry.
+    with os.scandir(label_clip_path) as entries:
+        label_timestamps = {entry.name for entry in entries if entry.is_dir()}
+
+    with os.scandir(image_clip_path) as timestamps:
+        for timestamp in timestamps:
+            if timestamp.name not in label_timestamps or not timestamp.is_dir():
+                continue  # skip unmatched labels
+
+            label_ts_path = os.path.join(label_clip_path, timestamp.name)
+            with os.scandir(label_ts_path) as entries:
+                label_files = {entry.name for entry in entries}
+
+            with os.scandir(timestamp.path) as frames:
+                for frame in frames:
+                    frame_file = frame.name
+                    if frame_file.endswith(".jpeg"):
+                        label_file = frame_file[: -len(".jpeg")] + ".png"
+                    else:
+                        label_file = frame_file
+
+                    if label_file in label_files:
+                        image_label_pairs.append(
+                            (
+                                frame.path,
+                                os.path.join(label_ts_path, label_file),
+                                label_ts_path,
+                                label_file.split(".")[0],
+                            )
+                        )
+
+    return image_label_pairs
 
+
+def collect_pairs(root_dir, num_workers=32):
+    image_clip_paths = []
+    label_clip_paths = []
     for root, dirs, _ in os.walk(root_dir):
         if os.path.basename(root) == "images":
+            label_root = os.path.join(os.path.dirname(root), "labels")
             for clip_id in dirs:
-                image_clip_path = os.path.join(root, clip_id)
-                label_clip_path = image_clip_path.replace("/images/", "/labels/")
-
-                for timestamp in os.listdir(image_clip_path):
-                    image_ts_path = os.path.join(image_clip_path, timestamp)
-                    label_ts_path = os.path.join(label_clip_path, timestamp)
-
-                    if not os.path.isdir(label_ts_path):
-                        continue  # skip unmatched labels
-
-                    for frame_file in os.listdir(image_ts_path):
-                        image_path = os.path.join(image_ts_path, frame_file)
-                        label_path = os.path.join(label_ts_path, frame_file.replace(".jpeg", ".png"))
-
-                        if os.path.exists(label_path):
-                            image_label_pairs.append((image_path, label_path))
+                image_clip_paths.append(os.path.join(root, clip_id))
+                label_clip_paths.append(os.path.join(label_root, clip_id))
+        if os.path.basename(root) in ["images", "labels"]:
+            dirs[:] = []  # clips are scanned below, no need to walk every frame
 
-    return image_label_pairs
+    # Listing is syscall bound and releases the GIL, so clips are scanned concurrently.
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        clip_pairs = executor.map(collect_clip_pairs, image_clip_paths, label_clip_paths)
+    return [pair for pairs in clip_pairs for pair in pairs]
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description="LISA chat")
@@ -100,8 +163,19 @@ def parse_args(args):
         "--vision-tower", default="openai/clip-vit-large-patch14", type=str
     )
     parser.add_argument("--local-rank", default=0, type=int, help="node rank")
-    parser.add_argument("--load_in_8bit", action="store_true", default=False)
-    parser.add_argument("--load_in_4bit", action="store_true", default=False)
+    parser.add_argument(
+        "--quantization",
+        default=None,
+        type=str,
+        choices=["bnb4", "gptq", "awq"],
+        help="bnb4 quantizes --version on load; gptq/awq expect --version to be a pre-quantized checkpoint",
+    )
+    parser.add_argument(
+        "--load_in_4bit",
+        action="store_true",
+        default=False,
+        help="deprecated, same as --quantization bnb4",
+    )
     parser.add_argument("--use_mm_start_end", action="store_true", default=True)
     parser.add_argument(
         "--conv_type",
@@ -110,42 +184,291 @@ def parse_args(args):
         choices=["llava_v1", "llava_llama_2"],
     )
     parser.add_argument("--folder_path", default="/content/LISA/gt_good_sample")
-    parser.add_argument("--prompt_number", type=int, default=1, help="Number of the prompt to use (e.g. 1, 2)")
-    return parser.parse_args(args)
-
+    parser.add_argument(
+        "--prompt_number",
+        type=int,
+        nargs="+",
+        default=[1],
+        choices=sorted(Prompts),
+        help="Number(s) of the prompt to use (e.g. 1 2), the SAM image embedding is shared between them",
+    )
+    parser.add_argument("--batch_size", default=8, type=int, help="frames per model.evaluate call")
+    parser.add_argument("--num_save_workers", default=4, type=int)
+    args = parser.parse_args(args)
 
-def preprocess(
-    x,
-    pixel_mean=torch.Tensor([123.675, 116.28, 103.53]).view(-1, 1, 1),
-    pixel_std=torch.Tensor([58.395, 57.12, 57.375]).view(-1, 1, 1),
-    img_size=1024,
-) -> torch.Tensor:
-    """Normalize pixel values and pad to a square input."""
+    if args.load_in_4bit:
+        if args.quantization not in [None, "bnb4"]:
+            parser.error("--load_in_4bit cannot be combined with --quantization {}".format(args.quantization))
+        print("--load_in_4bit is deprecated, use --quantization bnb4")
+        args.quantization = "bnb4"
+
+    # GPTQ/AWQ loading goes through transformers integrations newer than the
+    # pinned requirements, check for them before anything is downloaded.
+    if args.quantization in QUANTIZATION_REQUIREMENTS:
+        min_version, packages = QUANTIZATION_REQUIREMENTS[args.quantization]
+        missing = [name for name in packages if importlib.util.find_spec(name) is None]
+        if version.parse(transformers.__version__) < version.parse(min_version) or missing:
+            parser.error(
+                "--quantization {} needs transformers>={} and the {} packages, "
+                "found transformers=={}{}".format(
+                    args.quantization,
+                    min_version,
+                    ", ".join(packages),
+                    transformers.__version__,
+                    ", missing " + ", ".join(missing) if missing else "",
+                )
+            )
+    return args
+
+
+def preprocess_sam(x, pixel_mean, pixel_std, img_size=1024):
+    """
+    Resize the longest side to `img_size`, normalize pixel values and pad to a
+    square input in one pass on the GPU. Expects a uint8 BxCxHxW tensor, resizes
+    in float32 and returns the input in the dtype of `pixel_mean` with its
+    resized (h, w).
+    """
+    x = x.float()
+    # Resize, same target shape as ResizeLongestSide
+    target_size = ResizeLongestSide.get_preprocess_shape(x.shape[-2], x.shape[-1], img_size)
+    x = F.interpolate(x, target_size, mode="bilinear", align_corners=False, antialias=True)
     # Normalize colors
-    x = (x - pixel_mean) / pixel_std
+    x = (x.to(pixel_mean.dtype) - pixel_mean) / pixel_std
     # Pad
-    h, w = x.shape[-2:]
+    h, w = target_size
     padh = img_size - h
     padw = img_size - w
     x = F.pad(x, (0, padw, 0, padh))
+    return x, target_size
+
+
+def preprocess_clip(x, pixel_mean, pixel_std, size=224, crop_size=224) -> torch.Tensor:
+    """GPU counterpart of CLIPImageProcessor: resize the shortest side, center crop and normalize."""
+    h, w = x.shape[-2:]
+    if h <= w:
+        target_size = (size, int(size * w / h))
+    else:
+        target_size = (int(size * h / w), size)
+    x = F.interpolate(x, target_size, mode="bicubic", align_corners=False, antialias=True)
+    # Center crop
+    top = (target_size[0] - crop_size) // 2
+    left = (target_size[1] - crop_size) // 2
+    x = x[..., top : top + crop_size, left : left + crop_size]
+    # Normalize colors, mean and std are given on the 0-255 scale
+    x = (x.to(pixel_mean.dtype) - pixel_mean) / pixel_std
     return x
 
 
+def tokenize_prompt(prompt, tokenizer, conv_type, use_mm_start_end) -> torch.Tensor:
+    """Wrap `prompt` in the conversation template and return its [1, L] input_ids on the GPU."""
+    conv = conversation_lib.conv_templates[conv_type].copy()
+    conv.messages = []
+
+    prompt = DEFAULT_IMAGE_TOKEN + "\n" + prompt
+    if use_mm_start_end:
+        replace_token = (
+            DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN
+        )
+        prompt = prompt.replace(DEFAULT_IMAGE_TOKEN, replace_token)
+
+    conv.append_message(conv.roles[0], prompt)
+    conv.append_message(conv.roles[1], "")
+    prompt = conv.get_prompt()
+
+    input_ids = tokenizer_image_token(prompt, tokenizer, return_tensors="pt")
+    return input_ids.unsqueeze(0).cuda()
+
+
+def read_image(image_path) -> torch.Tensor:
+    """Read an image into pinned host memory, JPEGs are left encoded for nvJPEG."""
+    data = torchvision.io.read_file(image_path)
+    if not image_path.lower().endswith((".jpg", ".jpeg")):
+        data = torchvision.io.decode_image(data, mode=ImageReadMode.RGB)
+    return data.pin_memory()
+
+
+def load_image(data, device="cuda") -> torch.Tensor:
+    """Turn a read_image result into an RGB uint8 CxHxW tensor on `device`."""
+    if data.dim() == 1:
+        return torchvision.io.decode_jpeg(data, mode=ImageReadMode.RGB, device=device)
+    return data.to(device, non_blocking=True)
+
+
+def read_frames(batch_pairs):
+    """Read one batch of frames from disk, skipping missing images."""
+    frames = []
+    for img_path, lbl_path, parent_dir, base_name in batch_pairs:
+        print(f"Processing image: {img_path} {lbl_path}")
+
+        if not os.path.exists(img_path):
+            print(f"File not found in {img_path}")
+            continue
+
+        frames.append((read_image(img_path), (parent_dir, base_name)))
+    return frames
+
+
+def prepare_batch(
+    frames,
+    clip_image_processor,
+    pixel_mean,
+    pixel_std,
+    clip_pixel_mean,
+    clip_pixel_std,
+    image_size,
+):
+    """Build the stacked CLIP and SAM inputs for one batch of frames on the GPU."""
+    image_u8_list = []
+    image_clip_list = []
+    image_list = []
+    resize_list = []
+    original_size_list = []
+    output_name_list = []
+    for data, output_name in frames:
+        image_u8 = load_image(data)
+        original_size_list.append(tuple(image_u8.shape[-2:]))
+        image_clip = preprocess_clip(
+            image_u8.unsqueeze(0).float(),
+            clip_pixel_mean,
+            clip_pixel_std,
+            size=clip_image_processor.size["shortest_edge"],
+            crop_size=clip_image_processor.crop_size["height"],
+        )[0]
+
+        image, resize = preprocess_sam(image_u8.unsqueeze(0), pixel_mean, pixel_std, image_size)
+        resize_list.append(resize)
+        image = image[0]
+
+        image_u8_list.append(image_u8)
+        image_clip_list.append(image_clip)
+        image_list.append(image)
+        output_name_list.append(output_name)
+
+    if len(image_list) == 0:
+        return None
+
+    image_clip = torch.stack(image_clip_list, dim=0)
+    image = torch.stack(image_list, dim=0)
+
+    return image_u8_list, image_clip, image, resize_list, original_size_list, output_name_list
+
+
+def prefetch_batches(pairs, batch_size, prepare_fn):
+    """
+    Yield prepared batches one step ahead of the consumer: while batch N is
+    being evaluated, batch N+1 has been read by a background thread and its
+    upload/preprocessing is already queued on a side CUDA stream.
+    """
+    batches = [pairs[i : i + batch_size] for i in range(0, len(pairs), batch_size)]
+    copy_stream = torch.cuda.Stream()
+    with ThreadPoolExecutor(max_workers=1) as read_executor:
+        read_future = read_executor.submit(read_frames, batches[0]) if batches else None
+        pending = None
+        for batch_idx in range(len(batches) + 1):
+            prepared = None
+            if batch_idx < len(batches):
+                frames = read_future.result()
+                if batch_idx + 1 < len(batches):
+                    read_future = read_executor.submit(read_frames, batches[batch_idx + 1])
+
+                with torch.cuda.stream(copy_stream):
+                    batch = prepare_fn(frames)
+                if batch is not None:
+                    ready = torch.cuda.Event()
+                    ready.record(copy_stream)
+                    prepared = (batch, ready)
+
+            if pending is not None:
+                batch, ready = pending
+                compute_stream = torch.cuda.current_stream()
+                compute_stream.wait_event(ready)
+                # Tensors allocated on copy_stream are now used on the compute stream.
+                for tensor in [batch[1], batch[2]] + batch[0]:
+                    tensor.record_stream(compute_stream)
+                yield batch
+            pending = prepared
+
+
+def save_pred_mask(gray_mask, image_np, parent_dir, base_name, prompt_number):
+    """Write a 0/255 uint8 HxW mask and its red overlay next to the label file."""
+    # Only the mask of the first [SEG] token is exported, the `_0_` in the file
+    # names is kept so existing outputs are not renamed.
+    # Save as 1-bit PNG, masks are binary so libpng's bilevel encoder is exact
+    save_path = f"{parent_dir}/{base_name}_LISA_mask_0_prompt{prompt_number}.png"
+    gray_mask = gray_mask.numpy()
+    _, png = cv2.imencode(".png", gray_mask, PNG_MASK_PARAMS)
+    pathlib.Path(save_path).write_bytes(png.tobytes())
+    print(f"{save_path} has been saved.")
+
+    save_path = f"{parent_dir}/{base_name}_LISA_masked_img_0_prompt{prompt_number}.png"
+
+    # Blend only the masked pixels with red, in integer arithmetic. This matches
+    # the truncated float blend 0.5 * x + 0.5 * [255, 0, 0] exactly.
+    pred_mask = gray_mask > 0
+    save_img = image_np.copy()
+    masked = image_np[pred_mask]
+    blended = masked // 2
+    blended[:, 0] = (masked[:, 0].astype(np.uint16) + 255) // 2
+    save_img[pred_mask] = blended
+    save_img = cv2.cvtColor(save_img, cv2.COLOR_RGB2BGR)
+    _, png = cv2.imencode(".png", save_img, PNG_IMAGE_PARAMS)
+    pathlib.Path(save_path).write_bytes(png.tobytes())
+    print(f"{save_path} has been saved.")
+
+
 def main(args):
     args = parse_args(args)
     os.makedirs(args.vis_save_path, exist_ok=True)
 
     # Create model
     tokenizer = AutoTokenizer.from_pretrained(
+        args.version,
+        cache_dir=None,
+        model_max_length=args.model_max_length,
+        padding_side="right",
+        use_fast=True,
+    )
+    # The checkpoints were trained with the slow sentencepiece tokenizer. Only keep
+    # the fast one if it gives the same ids for every prompt this script sends and
+    # for a lone [SEG], which its normalizer may prefix with a "▁" token.
+    slow_tokenizer = AutoTokenizer.from_pretrained(
         args.version,
         cache_dir=None,
         model_max_length=args.model_max_length,
         padding_side="right",
         use_fast=False,
     )
+    seg_token_ids = tokenizer("[SEG]", add_special_tokens=False).input_ids
+    fast_matches = seg_token_ids == slow_tokenizer("[SEG]", add_special_tokens=False).input_ids
+    for prompt in Prompts.values():
+        if not fast_matches:
+            break
+        fast_ids = tokenize_prompt(prompt, tokenizer, args.conv_type, args.use_mm_start_end)
+        slow_ids = tokenize_prompt(prompt, slow_tokenizer, args.conv_type, args.use_mm_start_end)
+        fast_matches = torch.equal(fast_ids, slow_ids)
+    if not fast_matches:
+        print("Fast tokenizer does not match the slow one, using the slow tokenizer.")
+        tokenizer = slow_tokenizer
+        seg_token_ids = tokenizer("[SEG]", add_special_tokens=False).input_ids
+    del slow_tokenizer
     tokenizer.pad_token = tokenizer.unk_token
-    args.seg_token_idx = tokenizer("[SEG]", add_special_tokens=False).input_ids[0]
+    assert len(seg_token_ids) == 1, "[SEG] is not a single token: {}".format(seg_token_ids)
+    args.seg_token_idx = seg_token_ids[0]
+
 
+    # The 4-bit kernels fix the activation dtype: the exllama/AWQ W4A16 kernels
+    # run fp16, NF4 computes in bf16. The rest of the model follows it.
+    quantization_precision = {"bnb4": "bf16", "gptq": "fp16", "awq": "fp16"}
+    if (
+        args.quantization is not None
+        and args.precision != quantization_precision[args.quantization]
+    ):
+        precision = quantization_precision[args.quantization]
+        print("{} runs in {}, ignoring --precision={}".format(args.quantization, precision, args.precision))
+        args.precision = precision
+    # Quantized models are placed on the GPU by from_pretrained, casting or moving
+    # them again would re-quantize the packed 4-bit weights. Only the vision tower
+    # is moved below.
 
     torch_dtype = torch.float32
     if args.precision == "bf16":
@@ -154,28 +477,42 @@ def main(args):
         torch_dtype = torch.half
 
     kwargs = {"torch_dtype": torch_dtype}
-    if args.load_in_4bit:
+    if args.quantization == "bnb4":
         kwargs.update(
             {
-                "torch_dtype": torch.half,
+                "torch_dtype": torch.bfloat16,
                 "load_in_4bit": True,
                 "quantization_config": BitsAndBytesConfig(
                     load_in_4bit=True,
-                    bnb_4bit_compute_dtype=torch.float16,
+                    bnb_4bit_compute_dtype=torch.bfloat16,
                     bnb_4bit_use_double_quant=True,
                     bnb_4bit_quant_type="nf4",
                     llm_int8_skip_modules=["visual_model"],
+                    llm_int8_enable_fp32_cpu_offload=False,
                 ),
             }
         )
-    elif args.load_in_8bit:
+    elif args.quantization == "gptq":
+        from transformers import GPTQConfig
+
+        # The checkpoint's own quantization config decides which modules are
+        # quantized, from_pretrained only takes the loading options from here.
         kwargs.update(
             {
                 "torch_dtype": torch.half,
-                "quantization_config": BitsAndBytesConfig(
-                    llm_int8_skip_modules=["visual_model"],
-                    load_in_8bit=True,
-                ),
+                "device_map": {"": args.local_rank},
+                "quantization_config": GPTQConfig(bits=4, use_exllama=True),
+            }
+        )
+    elif args.quantization == "awq":
+        from transformers import AwqConfig
+
+        # As for GPTQ, the checkpoint's config selects the quantized modules.
+        kwargs.update(
+            {
+                "torch_dtype": torch.half,
+                "device_map": {"": args.local_rank},
+                "quantization_config": AwqConfig(bits=4),
             }
         )
 
@@ -191,158 +528,170 @@ def main(args):
     vision_tower = model.get_model().get_vision_tower()
     vision_tower.to(dtype=torch_dtype)
 
-    if args.precision == "bf16":
-        model = model.bfloat16().cuda()
-    elif (
-        args.precision == "fp16" and (not args.load_in_4bit) and (not args.load_in_8bit)
-    ):
-        vision_tower = model.get_model().get_vision_tower()
-        model.model.vision_tower = None
-        import deepspeed
-
-        model_engine = deepspeed.init_inference(
-            model=model,
-            dtype=torch.half,
-            replace_with_kernel_inject=True,
-            replace_method="auto",
-        )
-        model = model_engine.module
-        model.model.vision_tower = vision_tower.half().cuda()
+    deepspeed = None
+    if args.precision in ["bf16", "fp16"] and args.quantization is None:
+        try:
+            import deepspeed
+        except ImportError:
+            pass
+        if deepspeed is not None:
+            # Keep the CLIP tower out of the injection so its ViT is not replaced.
+            vision_tower = model.get_model().get_vision_tower()
+            model.model.vision_tower = None
+            model_engine = deepspeed.init_inference(
+                model=model,
+                dtype=torch_dtype,
+                replace_with_kernel_inject=True,
+                replace_method="auto",
+                tensor_parallel={"tp_size": int(os.environ.get("WORLD_SIZE", 1))},
+            )
+            model = model_engine.module
+            model.model.vision_tower = vision_tower.to(dtype=torch_dtype).cuda()
+        else:
+            model = model.to(dtype=torch_dtype).cuda()
     elif args.precision == "fp32":
         model = model.float().cuda()
 
+    # Kernel injection swaps the Llama decoder layers for DeepSpeed's fused ones,
+    # which expect the additive attention mask. The SDPA patch, including its
+    # mask override, is only installed when the stock layers are kept.
+    if deepspeed is None:
+        replace_llama_attn_with_sdpa()
+
     vision_tower = model.get_model().get_vision_tower()
     vision_tower.to(device=args.local_rank)
 
     clip_image_processor = CLIPImageProcessor.from_pretrained(model.config.vision_tower)
-    transform = ResizeLongestSide(args.image_size)
-
-    model.eval()
-    pairs = collect_pairs(args.folder_path)
-    print(f"Total pairs collected: {pairs}")
-    print(f"Prompt: {Prompts[args.prompt_number]}")
-    for img_path, lbl_path in pairs:
-        torch.cuda.empty_cache()
-        print(f"Processing image: {img_path} {lbl_path}")
-        conv = conversation_lib.conv_templates[args.conv_type].copy()
-        conv.messages = []
 
-        #prompt = input("Please input your prompt: ")
-        prompt = Prompts[args.prompt_number]
-
-        prompt = DEFAULT_IMAGE_TOKEN + "\n" + prompt
-        if args.use_mm_start_end:
-            replace_token = (
-                DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN
-            )
-            prompt = prompt.replace(DEFAULT_IMAGE_TOKEN, replace_token)
-
-        conv.append_message(conv.roles[0], prompt)
-        conv.append_message(conv.roles[1], "")
-        prompt = conv.get_prompt()
-
-        # image_path = input("Please input the image path: ")
-        image_path = img_path
-        if not os.path.exists(image_path):
-            print("File not found in {}".format(image_path))
-            continue
+    # Frames are decoded and preprocessed on the GPU, so the normalization
+    # constants are built once on the device and in the model dtype. Normalizing
+    # then also performs the cast to the model's input dtype.
+    pixel_mean = torch.tensor(
+        [123.675, 116.28, 103.53], device="cuda", dtype=torch_dtype
+    ).view(1, 3, 1, 1)
+    pixel_std = torch.tensor(
+        [58.395, 57.12, 57.375], device="cuda", dtype=torch_dtype
+    ).view(1, 3, 1, 1)
+    clip_pixel_mean = torch.tensor(
+        [255 * m for m in clip_image_processor.image_mean], device="cuda", dtype=torch_dtype
+    ).view(1, 3, 1, 1)
+    clip_pixel_std = torch.tensor(
+        [255 * s for s in clip_image_processor.image_std], device="cuda", dtype=torch_dtype
+    ).view(1, 3, 1, 1)
 
-        image_np = cv2.imread(image_path)
-        image_np = cv2.cvtColor(image_np, cv2.COLOR_BGR2RGB)
-        original_size_list = [image_np.shape[:2]]
-
-        image_clip = (
-            clip_image_processor.preprocess(image_np, return_tensors="pt")[
-                "pixel_values"
-            ][0]
-            .unsqueeze(0)
-            .cuda()
-        )
-        if args.precision == "bf16":
-            image_clip = image_clip.bfloat16()
-        elif args.precision == "fp16":
-            image_clip = image_clip.half()
-        else:
-            image_clip = image_clip.float()
-
-        image = transform.apply_image(image_np)
-        resize_list = [image.shape[:2]]
-
-        image = (
-            preprocess(torch.from_numpy(image).permute(2, 0, 1).contiguous())
-            .unsqueeze(0)
-            .cuda()
+    model.eval()
+    if hasattr(torch, "compile"):
+        # Only the SAM image encoder sees a fixed input shape, the LLM decode grows
+        # by one token per step and would keep recompiling. CUDA graphs are left
+        # off because the frame loop keeps every per-image output alive.
+        visual_model = model.get_model().visual_model
+        visual_model.image_encoder = torch.compile(visual_model.image_encoder)
+    image_encoder = model.get_model().visual_model.image_encoder
+    # Restricts the patched Llama attention to the fused SDPA backends, it has no
+    # effect on the decoder when DeepSpeed kernel injection is used.
+    if sdpa_kernel is not None:
+        attn_context = sdpa_kernel(
+            [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
         )
-        if args.precision == "bf16":
-            image = image.bfloat16()
-        elif args.precision == "fp16":
-            image = image.half()
-        else:
-            image = image.float()
-
-        input_ids = tokenizer_image_token(prompt, tokenizer, return_tensors="pt")
-        input_ids = input_ids.unsqueeze(0).cuda()
-
-        output_ids, pred_masks = model.evaluate(
-            image_clip,
-            image,
-            input_ids,
-            resize_list,
-            original_size_list,
-            max_new_tokens=512,
-            tokenizer=tokenizer,
+    else:
+        attn_context = contextlib.nullcontext()
+
+    # Sorted by path, so frames of a clip and timestamp are processed together.
+    pairs = sorted(collect_pairs(args.folder_path))
+    print(f"Total pairs collected: {len(pairs)}")
+    for prompt_number in args.prompt_number:
+        print(f"Prompt {prompt_number}: {Prompts[prompt_number]}")
+
+    # The prompts are fixed for the whole run, so each is tokenized once and
+    # repeated along the batch dimension for every call to model.evaluate.
+    input_ids_dict = {
+        prompt_number: tokenize_prompt(
+            Prompts[prompt_number], tokenizer, args.conv_type, args.use_mm_start_end
         )
-        output_ids = output_ids[0][output_ids[0] != IMAGE_TOKEN_INDEX]
-
-        text_output = tokenizer.decode(output_ids, skip_special_tokens=False)
-        text_output = text_output.replace("\n", "").replace("  ", " ")
-        print("text_output: ", text_output)
-        # Extract parent path
-        parent_dir = "/".join(lbl_path.split("/")[:-1])
-
-        # Extract filename without extension
-        base_name = lbl_path.split("/")[-1].split(".")[0]
-        for i, pred_mask in enumerate(pred_masks):
-            if pred_mask.shape[0] == 0:
-                continue
-
-            pred_mask = pred_mask.detach().cpu().numpy()[0]
-            pred_mask = pred_mask > 0
-            # Convert to uint8 for inspection and saving
-            pred_mask1 = pred_mask.astype(np.uint8)
-
-            # # Print min, max, and value counts
-            # print("Min:", pred_mask.min())
-            # print("Max:", pred_mask.max())
-            # print("Unique values and counts:", np.unique(pred_mask, return_counts=True))
-            # break
-            # Convert to grayscale [0, 255]
-            gray_mask = pred_mask1 * 255
-
-            # Save as grayscale PNG
-            save_path = "{}/{}_LISA_mask_{}_prompt{}.png".format(parent_dir, base_name, i, args.prompt_number)
-            cv2.imwrite(save_path, gray_mask)
-            # save_path = "{}/{}_mask_{}.jpg".format(
-            #    args.vis_save_path, image_path.split("/")[-1].split(".")[0], i
-            #)
-            # save_path = "{}/{}_LISA_mask_{}.png".format(parent_dir, base_name, i)
-
-            # cv2.imwrite(save_path, pred_mask * 100)
-            print("{} has been saved.".format(save_path))
-
-            # save_path = "{}/{}_masked_img_{}.jpg".format(
-            #    args.vis_save_path, image_path.split("/")[-1].split(".")[0], i
-            #)
-            save_path = "{}/{}_LISA_masked_img_{}_prompt{}.png".format(parent_dir, base_name, i, args.prompt_number)
-
-            save_img = image_np.copy()
-            save_img[pred_mask] = (
-                image_np * 0.5
-                + pred_mask[:, :, None].astype(np.uint8) * np.array([255, 0, 0]) * 0.5
-            )[pred_mask]
-            save_img = cv2.cvtColor(save_img, cv2.COLOR_RGB2BGR)
-            cv2.imwrite(save_path, save_img)
-            print("{} has been saved.".format(save_path))
+        for prompt_number in args.prompt_number
+    }
+
+    # PNG encoding releases the GIL, so masks are written in the background
+    # while the next batch is running on the GPU.
+    save_executor = ThreadPoolExecutor(max_workers=args.num_save_workers)
+    save_futures = []
+
+    prepare_fn = functools.partial(
+        prepare_batch,
+        clip_image_processor=clip_image_processor,
+        pixel_mean=pixel_mean,
+        pixel_std=pixel_std,
+        clip_pixel_mean=clip_pixel_mean,
+        clip_pixel_std=clip_pixel_std,
+        image_size=args.image_size,
+    )
+
+    with torch.inference_mode(), attn_context:
+        for batch in prefetch_batches(pairs, args.batch_size, prepare_fn):
+            (
+                image_u8_list,
+                image_clip,
+                image,
+                resize_list,
+                original_size_list,
+                output_name_list,
+            ) = batch
+
+            # The SAM ViT-H embedding only depends on the image, encode it once
+            # and let every prompt reuse it in the mask decoder. The encoder is
+            # called directly, get_visual_embs empties the CUDA cache per image.
+            image_embeddings = torch.cat(
+                [image_encoder(image[i : i + 1]) for i in range(image.shape[0])], 0
+            )
+            image_np_list = [None] * len(output_name_list)
+
+            for prompt_number, input_ids in input_ids_dict.items():
+                output_ids, pred_masks = model.evaluate(
+                    image_clip,
+                    image,
+                    input_ids.expand(len(output_name_list), -1),
+                    resize_list,
+                    original_size_list,
+                    max_new_tokens=512,
+                    tokenizer=tokenizer,
+                    image_embeddings=image_embeddings,
+                )
+
+                for j, (parent_dir, base_name) in enumerate(output_name_list):
+                    # Frames that hit EOS early are padded up to the longest one in
+                    # the batch, drop the padding so only the generated text is shown.
+                    sample_output_ids = output_ids[j][
+                        (output_ids[j] != IMAGE_TOKEN_INDEX)
+                        & (output_ids[j] != tokenizer.pad_token_id)
+                    ]
+
+                    text_output = tokenizer.decode(sample_output_ids, skip_special_tokens=False)
+                    text_output = text_output.replace("\n", "").replace("  ", " ")
+                    print("text_output: ", text_output)
+
+                    # Only the first [SEG] mask of each frame is exported, as before.
+                    pred_mask = pred_masks[j]
+                    if pred_mask.shape[0] == 0:
+                        continue
+
+                    # Threshold on the GPU so only one byte per pixel crosses PCIe.
+                    gray_mask = (pred_mask[0] > 0).to(torch.uint8).mul_(255).cpu()
+                    if image_np_list[j] is None:
+                        image_np_list[j] = image_u8_list[j].permute(1, 2, 0).cpu().numpy()
+                    save_futures.append(
+                        save_executor.submit(
+                            save_pred_mask,
+                            gray_mask,
+                            image_np_list[j],
+                            parent_dir,
+                            base_name,
+                            prompt_number,
+                        )
+                    )
+
+    save_executor.shutdown(wait=True)
+    for future in save_futures:
+        future.result()
 
 
 if __name__ == "__main__":
@@ -351,8 +351,9 @@ class LISAForCausalLM(LlavaLlamaForCausalLM):
         original_size_list,
         max_new_tokens=32,
         tokenizer=None,
+        image_embeddings=None,
     ):
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = self.generate(
                 images=images_clip,
                 input_ids=input_ids,
@@ -360,8 +361,12 @@ class LISAForCausalLM(LlavaLlamaForCausalLM):
                 num_beams=1,
                 output_hidden_states=True,
                 return_dict_in_generate=True,
+                use_cache=True,
             )
-            output_hidden_states = outputs.hidden_states[-1]
+            # with the KV cache the first step holds the hidden states of the whole
+            # prompt and every later step only the newly generated token, so the
+            # full sequence is their concatenation
+            output_hidden_states = torch.cat(outputs.hidden_states, dim=1)
             output_ids = outputs.sequences
 
             seg_token_mask = output_ids[:, 1:] == self.seg_token_idx
@@ -394,7 +399,10 @@ class LISAForCausalLM(LlavaLlamaForCausalLM):
                 pred_embeddings_.append(pred_embeddings[start_i:end_i])
             pred_embeddings = pred_embeddings_
 
-            image_embeddings = self.get_visual_embs(images)
+            # callers running several prompts over the same images can pass the
+            # SAM embeddings from get_visual_embs instead of re-encoding them
+            if image_embeddings is None:
+                image_embeddings = self.get_visual_embs(images)
 
             multimask_output = False
             pred_masks = []
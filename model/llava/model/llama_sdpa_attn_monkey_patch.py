@@ -0,0 +1,107 @@
+import logging
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+import transformers
+from transformers.models.llama.modeling_llama import (apply_rotary_pos_emb,
+                                                      repeat_kv)
+
+_prepare_decoder_attention_mask_orig = (
+    transformers.models.llama.modeling_llama.LlamaModel._prepare_decoder_attention_mask
+)
+
+
+def forward(
+    self,
+    hidden_states: torch.Tensor,
+    attention_mask: Optional[torch.Tensor] = None,
+    position_ids: Optional[torch.Tensor] = None,
+    past_key_value: Optional[Tuple[torch.Tensor]] = None,
+    output_attentions: bool = False,
+    use_cache: bool = False,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+    """Input shape: Batch x Time x Channel
+
+    attention_mask: None for an unpadded causal prefill, otherwise the additive
+    [bsz, 1, q_len, kv_seq_len] mask built by LlamaModel
+    """
+    assert not output_attentions, "output_attentions is not supported"
+    bsz, q_len, _ = hidden_states.size()
+
+    query_states = (
+        self.q_proj(hidden_states)
+        .view(bsz, q_len, self.num_heads, self.head_dim)
+        .transpose(1, 2)
+    )
+    key_states = (
+        self.k_proj(hidden_states)
+        .view(bsz, q_len, self.num_key_value_heads, self.head_dim)
+        .transpose(1, 2)
+    )
+    value_states = (
+        self.v_proj(hidden_states)
+        .view(bsz, q_len, self.num_key_value_heads, self.head_dim)
+        .transpose(1, 2)
+    )
+    # [bsz, nh, q_len, hd]
+
+    kv_seq_len = key_states.shape[-2]
+    if past_key_value is not None:
+        kv_seq_len += past_key_value[0].shape[-2]
+    cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+    query_states, key_states = apply_rotary_pos_emb(
+        query_states, key_states, cos, sin, position_ids
+    )
+
+    if past_key_value is not None:
+        # reuse k, v, self_attention
+        key_states = torch.cat([past_key_value[0], key_states], dim=2)
+        value_states = torch.cat([past_key_value[1], value_states], dim=2)
+
+    past_key_value = (key_states, value_states) if use_cache else None
+
+    # repeat k/v heads if n_kv_heads < n_heads
+    key_states = repeat_kv(key_states, self.num_key_value_groups)
+    value_states = repeat_kv(value_states, self.num_key_value_groups)
+
+    # Without an explicit mask SDPA can dispatch to the fused flash kernel,
+    # which never materializes the [q_len, kv_seq_len] attention matrix.
+    output = F.scaled_dot_product_attention(
+        query_states,
+        key_states,
+        value_states,
+        attn_mask=attention_mask,
+        is_causal=attention_mask is None and q_len > 1,
+    )
+    output = output.transpose(1, 2).reshape(bsz, q_len, self.hidden_size)
+    return self.o_proj(output), None, past_key_value
+
+
+# Drop the attention mask when nothing is padded and there is no cache, so the
+# causal case goes through `is_causal=True` instead of an additive mask.
+def _prepare_decoder_attention_mask(
+    self, attention_mask, input_shape, inputs_embeds, past_key_values_length
+):
+    if (
+        past_key_values_length == 0
+        and input_shape[-1] > 1
+        and (attention_mask is None or bool(attention_mask.all()))
+    ):
+        return None
+    return _prepare_decoder_attention_mask_orig(
+        self, attention_mask, input_shape, inputs_embeds, past_key_values_length
+    )
+
+
+def replace_llama_attn_with_sdpa():
+    if not hasattr(F, "scaled_dot_product_attention"):
+        logging.warning(
+            "torch.nn.functional.scaled_dot_product_attention requires torch>=2.0, "
+            "keeping the eager Llama attention."
+        )
+        return
+    transformers.models.llama.modeling_llama.LlamaModel._prepare_decoder_attention_mask = (
+        _prepare_decoder_attention_mask
+    )
+    transformers.models.llama.modeling_llama.LlamaAttention.forward = forward